@@ -6,28 +6,81 @@ Install requirements with pip3 install -r requirements.txt
 #%%
 import netCDF4 as nc4
 import numpy as np
+import pandas as pd
 import os
-import argparse
 import xarray as xr
-import cartopy.crs as ccrs
+from scipy import ndimage
+from scipy.spatial import cKDTree
 from datetime import datetime
 from datetime import timedelta
 from dateutil.relativedelta import relativedelta
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+ERA5_DATA_DIR = "/lustre/storeB/project/fou/om/ERA/ERA5"
+NORA3_DATA_DIR = "/lustre/storeB/project/fou/om/WINDSURFER/HM40h12/netcdf"
+
+# available parameters, built once at import instead of on every call
+ERA5_ATM_PARAMS = frozenset(["msl", "u10", "v10"])
+ERA5_WAVE_PARAMS = frozenset(["msl", "mwd", "mp2", "pp1d", "swh"])
+NORA3_ATM_PARAMS = frozenset(["air_pressure_at_sea_level", "x_wind_10m", "y_wind_10m"])
+
+# the files are given in time order and share their grid, so concatenate them along
+# time as listed and take the coordinates from the first file without comparing
+MFDATASET_KWARGS = {
+    "combine": "nested",
+    "concat_dim": "time",
+    "data_vars": "minimal",
+    "coords": "minimal",
+    "compat": "override",
+    "parallel": True,
+}
+
+# target size of the chunks of the time series written by write_timeseries
+OUTPUT_CHUNK_BYTES = 1000000
+
+# set NORA3_ERA5_VERBOSE in the environment to print the data of every stride written
+VERBOSE = bool(os.environ.get("NORA3_ERA5_VERBOSE"))
+
+# (min, max) of the parameters written by write_timeseries as packed 16 bit integers;
+# fixed per parameter so every appended stride uses the same scale_factor/add_offset
+OUTPUT_PACKING_RANGES = {
+    "msl": (85000.0, 110000.0),   # Pa
+    "u10": (-80.0, 80.0),         # m s-1
+    "v10": (-80.0, 80.0),         # m s-1
+    "swh": (0.0, 30.0),           # m
+    "mwd": (0.0, 360.0),          # degree true
+    "mp2": (0.0, 50.0),           # s
+    "pp1d": (0.0, 50.0),          # s
+}
+
+# ERA5 parameter names and their NORA3 equivalents
+ATM_PARAMS_NORA3 = {
+    "msl": "air_pressure_at_sea_level",
+    "u10": "x_wind_10m",
+    "v10": "y_wind_10m"
+}
 
 def _expand_variable(nc_variable, data, expanding_dim, nc_shape, added_size):
     """For time deltas, we must ensure that we use the same encoding as
     what was previously stored.
-    We likely need to do this as well for variables that had custom
-    econdings too
+    The same goes for packed variables: data is encoded with the dtype, scale_factor,
+    add_offset and fill value of the stored variable, not with the encoding it was
+    read with.
 
     Author: Mark Harfouche (https://github.com/pydata/xarray/issues/1672#issuecomment-685222909)
     """
+    data = data.copy(deep=False)
+    data.encoding = {'dtype': nc_variable.dtype}
     if hasattr(nc_variable, 'calendar'):
-        
-        data.encoding = {
+        data.encoding.update({
             'units': nc_variable.units,
             'calendar': nc_variable.calendar,
-        }
+        })
+    for attr in ('scale_factor', 'add_offset', '_FillValue', 'missing_value'):
+        if attr in nc_variable.ncattrs():
+            data.encoding[attr] = nc_variable.getncattr(attr)
     data_encoded = xr.conventions.encode_cf_variable(data) # , name=name)
     left_slices = data.dims.index(expanding_dim)
     right_slices = data.ndim - left_slices - 1
@@ -52,7 +105,9 @@ def append_to_netcdf(filename, ds_to_append, unlimited_dims):
     expanding_dim = unlimited_dims[0]
     
     with nc4.Dataset(filename, mode='a') as nc:
-        nc_dims = set(nc.dimensions.keys())
+        # variables are CF encoded by xarray before writing, so netCDF4 must not
+        # mask or rescale them a second time
+        nc.set_auto_maskandscale(False)
 
         nc_coord = nc[expanding_dim]
         nc_shape = len(nc_coord)
@@ -68,48 +123,256 @@ def append_to_netcdf(filename, ds_to_append, unlimited_dims):
             nc_variable = nc[name]
             _expand_variable(nc_variable, data, expanding_dim, nc_shape, added_size)
 
-def get_closest_water_point(start_i, start_j, data, missing_value=-32767):
+def nearest_valid_lookup(data, missing_value=-32767):
+    """Index arrays (i, j) mapping every point of data to its nearest non-missing_value point.
+
+    Computing the lookup takes one distance transform of the whole grid. Pass it as
+    lookup= to get_closest_water_point to share it between lookups on the same grid;
+    it must be recomputed if data is changed.
+    """
+    valid = np.asarray(data) != missing_value
+    if not np.any(valid):
+        raise ValueError("No points in data differ from missing_value " + str(missing_value))
+
+    return ndimage.distance_transform_edt(~valid, return_distances=False, return_indices=True)
+
+def get_closest_water_point(start_i, start_j, data, missing_value=-32767, lookup=None):
     """
     Code from josteinb@met.no (adapted)
 
     desc:
-        Breadth first search function to find index of nearest
-        non-missing_value point
+        Find index of nearest non-missing_value point using an euclidean
+        distance transform of the missing_value mask
     args:
-        - start_i: Start index of i
-        - start_j: Start index of j
+        - start_i: Start index of i, or array of them
+        - start_j: Start index of j, or array of them
         - data: grid with data
         - missing_value: value of missing_value for paramter
+        - lookup: result of nearest_valid_lookup(data, missing_value), computed
+          here if not given. Look up many points with arrays of start indices,
+          or by passing the same lookup, so they share one distance transform
     return:
-        - index of point
+        - index of point (integers, or arrays for array start indices)
+    """
+    start_i = np.asarray(start_i)
+    start_j = np.asarray(start_j)
+    if (np.any(start_i < 0) or np.any(start_i >= data.shape[0])
+            or np.any(start_j < 0) or np.any(start_j >= data.shape[1])):
+        raise IndexError("Start index ({}, {}) outside grid of shape {}".format(
+            start_i, start_j, data.shape))
+
+    if lookup is None:
+        lookup = nearest_valid_lookup(data, missing_value)
+    closest_i = lookup[0][start_i, start_j]
+    closest_j = lookup[1][start_i, start_j]
+    if closest_i.ndim == 0:
+        return int(closest_i), int(closest_j)
+    return closest_i, closest_j
+
+def _disk_chunks(filename, param):
+    """Read the on-disk chunk sizes of variable param in filename.
+
+    Returns a dict {dimension: chunk size} to be passed as chunks= to xarray, so
+    that dask reads whole disk chunks and nothing more. Contiguous variables give
+    an empty dict, which lets xarray choose.
+    """
+    with nc4.Dataset(filename, mode="r") as nc:
+        nc_variable = nc.variables[param]
+        chunking = nc_variable.chunking()
+        if chunking == "contiguous":
+            return {}
+        return dict(zip(nc_variable.dimensions, chunking))
+
+def _nearest_grid_indices(grid_lat, grid_lon, lat, lon, tree=None):
+    """Find (y, x) indices of the grid points closest to the location(s) (lat, lon).
+
+    The distance is the largest of the latitude and longitude differences. All
+    locations are looked up in one batched query against a KD-tree of the grid,
+    which is built here unless a prebuilt tree is given.
+
+    Returns a tuple of integers for scalar lat/lon, or of xarray indexers along a
+    "station" dimension for array lat/lon.
+    """
+    if tree is None:
+        tree = cKDTree(np.column_stack([grid_lat.ravel(), grid_lon.ravel()]))
+    _, flat_idx = tree.query(np.column_stack([np.ravel(lat), np.ravel(lon)]), p=np.inf)
+    y_idx, x_idx = np.unravel_index(flat_idx, grid_lat.shape)
+
+    if np.ndim(lat) == 0 and np.ndim(lon) == 0:
+        return int(y_idx[0]), int(x_idx[0])
+    return xr.DataArray(y_idx, dims="station"), xr.DataArray(x_idx, dims="station")
+
+# (latitude, longitude, KD-tree) of the NORA3 grid, set by the first call to _nora3_grid
+_nora3_grid_cache = None
+
+def _nora3_grid(filename):
+    """Latitude, longitude and KD-tree of the NORA3 grid.
+
+    The grid is the same in every NORA3 file, so it is read from filename and indexed on
+    the first call only. Later calls return that grid whatever filename they are given,
+    e.g. for every time stride of a long run.
+    """
+    global _nora3_grid_cache
+    if _nora3_grid_cache is None:
+        with nc4.Dataset(filename, mode="r") as nc:
+            grid_lat = np.asarray(nc.variables["latitude"][:])
+            grid_lon = np.asarray(nc.variables["longitude"][:])
+        tree = cKDTree(np.column_stack([grid_lat.ravel(), grid_lon.ravel()]))
+        _nora3_grid_cache = (grid_lat, grid_lon, tree)
+
+    return _nora3_grid_cache
+
+def _nora3_filenames(start_time, end_time):
+    """List the NORA3 files holding each hour in the interval [start_time, end_time].
+
+    Hour t is found in the forecast started in the six-hourly period before t - 4h,
+    in the file with lead time index t.hour - period (modulo 24).
     """
-    dirs = [(1, 0), (-1, 0), (0, 1), (0, -1)]
-    visited = set()
-    q = [(start_i, start_j)]    # init queue to start pos
-    count = 0
-
-    # while something in queue
-    while q:
-        current = q.pop(0)      # pop the first in waiting queue
-        # if we have visited this before
-        if current in visited:
-            continue
-        visited.add(current)    # Add to set of visited
-        # If not in border list
-        # Test if this is land, if true go to next in queue, else return idx
-        if data[current[0], current[1]] != missing_value:
-            return current[0], current[1]
-        count += 1      # updates the count
-        # Loop over neighbours and add to queue
-        for di, dj in dirs:
-            new_i = current[0]+di
-            new_j = current[1]+dj
-            q.append((new_i, new_j))
+    times = pd.date_range(start_time, end_time, freq=timedelta(hours=1))
+    times_with_offset = times - timedelta(hours=4)
+
+    # find correct period folder and index file
+    periods = (times_with_offset.hour.values // 6) * 6
+    index_files = (times.hour.values - periods) % 24
+
+    data_dir = os.path.join(NORA3_DATA_DIR, "")
+    return [
+        f"{data_dir}{year:04d}/{month:02d}/{day:02d}/{period:02d}/"
+        f"fc{year:04d}{month:02d}{day:02d}{period:02d}_00{index_file}_fp.nc"
+        for year, month, day, period, index_file in zip(
+            times_with_offset.year.tolist(), times_with_offset.month.tolist(),
+            times_with_offset.day.tolist(), periods.tolist(), index_files.tolist())
+    ]
+
+@lru_cache(maxsize=None)
+def _open_era5_month(filename, param):
+    """Open one monthly ERA5 file lazily.
+
+    Cached per month, so extractions whose intervals overlap, such as consecutive
+    time strides or stations, reuse the opened file instead of parsing its metadata
+    again. xarray's own file cache bounds the number of file handles kept open.
+    """
+    return xr.open_dataset(filename, chunks=_disk_chunks(filename, param))
+
+def _open_era5(filenames, param):
+    """Open the monthly ERA5 files (in time order) lazily as one dataset."""
+    months = [_open_era5_month(filename, param) for filename in filenames]
+    if len(months) == 1:
+        return months[0]
+    return xr.concat(months, dim="time", data_vars="minimal", coords="minimal",
+                     compat="override")
+
+@lru_cache(maxsize=8)
+def _open_nora3(filenames, params):
+    """Open the NORA3 files (a tuple) lazily, keeping only the parameters params (a tuple).
+
+    Cached, so back-to-back extractions over the same hours reuse the opened
+    dataset instead of parsing the file metadata again.
+    """
+    return xr.open_mfdataset(list(filenames), chunks=_disk_chunks(filenames[0], params[0]),
+                             preprocess=lambda ds: ds[list(params)], **MFDATASET_KWARGS)
+
+def _read_nora3_file(filename, indices):
+    """Read the time and the values at indices ({param: [index, ...]}) of one NORA3 file.
+
+    Returns (times, {param: values}), with the raw (still packed) point values along
+    the last axis.
+    """
+    with nc4.Dataset(filename, mode="r") as nc:
+        # masked arrays are costly for tiny reads, fill values are replaced and packed
+        # values unpacked by the caller
+        nc.set_auto_mask(False)
+        for a_param in indices:
+            nc.variables[a_param].set_auto_maskandscale(False)
+
+        nc_time = nc.variables["time"]
+        times = nc4.num2date(nc_time[:], nc_time.units,
+                             getattr(nc_time, "calendar", "standard"),
+                             only_use_cftime_datetimes=False,
+                             only_use_python_datetimes=True)
+        values = {
+            a_param: np.stack([nc.variables[a_param][index] for index in param_indices], axis=-1)
+            for a_param, param_indices in indices.items()
+        }
+    return times, values
+
+def _read_nora3_points(filenames, params, y_idx, x_idx, max_workers=1):
+    """Read params at grid point(s) (y_idx, x_idx) from each NORA3 file with netCDF4.
+
+    Only the requested values and the time of each file are read, which avoids the
+    coordinate decoding and merging of open_mfdataset. y_idx and x_idx are integers or
+    "station" indexers, as returned by _nearest_grid_indices.
+
+    With max_workers > 1 the files are read by a pool of that many processes, which
+    overlaps the many small reads. Processes rather than threads, since netCDF-C/HDF5
+    are generally not built thread-safe.
+
+    Returns an xarray Dataset with time and station coordinates only.
+    """
+    stations = np.ndim(y_idx) > 0
+    points = list(zip(np.ravel(y_idx), np.ravel(x_idx)))
+
+    # dimensions, point indices, fill values and packing are the same in every file
+    dims = {}
+    indices = {}
+    fill_values = {}
+    packing = {}
+    coords = {}
+    with nc4.Dataset(filenames[0], mode="r") as nc:
+        nc.set_auto_mask(False)
+        for a_param in params:
+            nc_variable = nc.variables[a_param]
+            dims[a_param] = [dim for dim in nc_variable.dimensions if dim not in ("y", "x")]
+            for dim in dims[a_param]:
+                if dim != "time" and dim in nc.variables and dim not in coords:
+                    coords[dim] = nc.variables[dim][:]
+
+            # one read per point, leaving all other dimensions whole
+            indices[a_param] = [
+                tuple(y_point if dim == "y" else x_point if dim == "x" else slice(None)
+                      for dim in nc_variable.dimensions)
+                for y_point, x_point in points
+            ]
+            fill_values[a_param] = [np.ravel(nc_variable.getncattr(attr))
+                                    for attr in ("_FillValue", "missing_value")
+                                    if attr in nc_variable.ncattrs()]
+            packing[a_param] = (getattr(nc_variable, "scale_factor", None),
+                                getattr(nc_variable, "add_offset", None))
+
+    if max_workers > 1:
+        chunksize = max(1, len(filenames) // (4 * max_workers))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_read_nora3_file, filenames, repeat(indices),
+                                        chunksize=chunksize))
+    else:
+        results = [_read_nora3_file(filename, indices) for filename in filenames]
+
+    data_vars = {}
+    for a_param in params:
+        data = np.concatenate([values[a_param] for _, values in results],
+                              axis=dims[a_param].index("time"))
+        # compare with the fill values before unpacking, as xarray does
+        missing = np.isin(data, np.concatenate(fill_values[a_param])) \
+            if fill_values[a_param] else None
+        scale_factor, add_offset = packing[a_param]
+        if scale_factor is not None:
+            data = data * scale_factor
+        if add_offset is not None:
+            data = data + add_offset
+        if missing is not None:
+            data = np.where(missing, np.nan, data)
+        if stations:
+            data_vars[a_param] = (dims[a_param] + ["station"], data)
+        else:
+            data_vars[a_param] = (dims[a_param], data[..., 0])
+
+    coords["time"] = np.concatenate([times for times, _ in results]).astype("datetime64[ns]")
+    return xr.Dataset(data_vars, coords=coords)
 
 def get_timeseries(param, lon, lat, start_time, end_time, use_atm=True):
     """Time series extraction from NORA3 and ERA5.
 
-    NOTE: Use ERA5 parameter names. See atm_params_nora3 for NORA3 equivalents
+    NOTE: Use ERA5 parameter names. See ATM_PARAMS_NORA3 for NORA3 equivalents
 
     Returns tuple with string "NORA3" or "ERA5" depending on which data set was
     used, and time series xarray for parameter param at location (lat, lon) in 
@@ -121,17 +384,8 @@ def get_timeseries(param, lon, lat, start_time, end_time, use_atm=True):
     /lustre/storeB/project/fou/om/ERA/ERA5 [1979-1, 2019-12]
     /lustre/storeB/project/fou/om/WINDSURFER/HM40h12/netcdf [1997-08, 2019-12]
     """
-    available_atm_params = ["msl", "u10", "v10"]
-    available_wave_params = ["msl", "mwd", "mp2", "pp1d", "swh"]
-
-    atm_params_nora3 = {
-        "msl": "air_pressure_at_sea_level",
-        "u10": "x_wind_10m",
-        "v10": "y_wind_10m"
-    }
-
     # sanity check arguments
-    if param not in available_atm_params and param not in available_wave_params:
+    if param not in ERA5_ATM_PARAMS and param not in ERA5_WAVE_PARAMS:
         raise RuntimeError("Undefined parameter: " + param)
     if datetime(2019, 12, 31) < start_time or start_time < datetime(1979, 1, 1):
         raise RuntimeError("Start time outside data set time interval")
@@ -140,9 +394,38 @@ def get_timeseries(param, lon, lat, start_time, end_time, use_atm=True):
 
     # inside time interval and domain for NORA3?
     if start_time >= datetime(1997, 8, 1, 4, 0, 0) and (44.0 <= lat <= 83.0) and (-30.0 <= lon <= 85.0):
-        return ("NORA3", get_nora3_timeseries(atm_params_nora3[param], lat, lon, start_time, end_time))
+        return ("NORA3", get_nora3_timeseries(ATM_PARAMS_NORA3[param], lon=lon, lat=lat,
+                                              start_time=start_time, end_time=end_time))
     else:
-        return ("ERA5", get_era5_timeseries(param, lat, lon, start_time, end_time, use_atm))
+        return ("ERA5", get_era5_timeseries(param, lon=lon, lat=lat, start_time=start_time,
+                                            end_time=end_time, use_atm=use_atm))
+
+def _regular_grid_indices(coords, values, periodic=False):
+    """Find the indices of the coordinates closest to values on a regular 1-D grid.
+
+    The index is computed arithmetically from the first coordinate and the spacing,
+    instead of searching the coordinate array. With periodic=True values are longitudes,
+    taken as the equivalent angle closest to the grid; a grid covering the full 360
+    degrees wraps around, a regional one is clamped at its nearest edge. Falls back to
+    a search if the coordinates are not evenly spaced.
+    """
+    values = np.asarray(values, dtype=float)
+    if periodic:
+        centre = (np.min(coords) + np.max(coords)) / 2.0
+        values = centre + np.mod(values - centre + 180.0, 360.0) - 180.0
+    spacing = np.diff(coords)
+    if len(coords) > 1 and np.allclose(spacing, spacing[0]):
+        indices = np.round((values - coords[0]) / spacing[0]).astype(int)
+        if periodic and np.isclose(len(coords) * abs(spacing[0]), 360.0):
+            indices = indices % len(coords)
+        else:
+            indices = np.clip(indices, 0, len(coords) - 1)
+    else:
+        indices = np.abs(np.subtract.outer(coords, values)).argmin(axis=0)
+
+    if indices.ndim == 0:
+        return int(indices)
+    return indices
 
 def get_era5_timeseries(param, lon, lat, start_time, end_time, use_atm=True):
     """Time series extraction from ERA5.
@@ -151,20 +434,20 @@ def get_era5_timeseries(param, lon, lat, start_time, end_time, use_atm=True):
     [start_time, end_time] with a temporal resolution of one hour. The nearest 
     grid point will be used.
 
+    lon and lat may also be arrays of station locations, in which case all stations
+    are selected in one operation and the result has an additional "station" dimension.
+    Longitudes outside [0.0, 360.0), e.g. negative ones, are wrapped into that interval.
+
     Data directories: 
     /lustre/storeB/project/fou/om/ERA/ERA5 [1979-1, 2019-12]
     """
-    data_dir = "/lustre/storeB/project/fou/om/ERA/ERA5"
-    available_atm_params = ["msl", "u10", "v10"]
-    available_wave_params = ["msl", "mwd", "mp2", "pp1d", "swh"]
-    
     # sanity check arguments
-    if param not in available_atm_params and param not in available_wave_params:
+    if param not in ERA5_ATM_PARAMS and param not in ERA5_WAVE_PARAMS:
         raise RuntimeError("Undefined parameter: " + param)
-    if -90.0 > lat > 90.0:
+    if np.any(np.asarray(lat) < -90.0) or np.any(np.asarray(lat) > 90.0):
         raise RuntimeError("Latitude (lat) must be in the interval [-90.0, 90.0]")
-    if 0.0 > lon >= 360.0:
-        raise RuntimeError("Longitude (lon) must be in the interval [0.0, 360.0)")
+    # ERA5 longitudes are in [0.0, 360.0), wrap e.g. negative (NORA3 style) longitudes
+    lon = np.mod(lon, 360.0)
     
     #print("From " + start_time.strftime("%Y%m-%H%M"))
     #print("To " + end_time.strftime("%Y%m-%H%M"))
@@ -175,83 +458,95 @@ def get_era5_timeseries(param, lon, lat, start_time, end_time, use_atm=True):
     
     #print("Months:" + str(month_count))
 
-    if param in available_atm_params and use_atm:
+    if param in ERA5_ATM_PARAMS and use_atm:
         for month in (start_time + relativedelta(months=+n) for n in range(month_count)):
-            filenames.append(os.path.join(data_dir, "atm/era5_atm_CDS_{}.nc".format(month.strftime("%Y%m"))))
-    elif param in available_wave_params:
+            filenames.append(os.path.join(ERA5_DATA_DIR, "atm/era5_atm_CDS_{}.nc".format(month.strftime("%Y%m"))))
+    elif param in ERA5_WAVE_PARAMS:
         for month in (start_time + relativedelta(months=+n) for n in range(month_count)):
-            filenames.append(os.path.join(data_dir, "wave/era5_wave_CDS_{}.nc".format(month.strftime("%Y%m"))))
+            filenames.append(os.path.join(ERA5_DATA_DIR, "wave/era5_wave_CDS_{}.nc".format(month.strftime("%Y%m"))))
     else:
         raise RuntimeError(param + " is not found in ERA5 wave data set (try use_atm=True)")
     
-    era5 = xr.open_mfdataset(filenames, parallel=True)
-
-    # extract data set
-    era5_da = era5[param].sel(longitude=lon, latitude=lat, method="nearest")
-    era5_da = era5_da.sel(time=slice(start_time, end_time))
+    era5 = _open_era5(filenames, param)
+
+    # extract data set, slicing time first so dask prunes chunks outside the interval
+    era5_da = era5[param].sel(time=slice(start_time, end_time))
+    lon_idx = _regular_grid_indices(era5.longitude.values, lon, periodic=True)
+    lat_idx = _regular_grid_indices(era5.latitude.values, lat)
+    if np.ndim(lon) > 0 or np.ndim(lat) > 0:
+        lon_idx, lat_idx = np.broadcast_arrays(lon_idx, lat_idx)
+        lon_idx = xr.DataArray(lon_idx, dims="station")
+        lat_idx = xr.DataArray(lat_idx, dims="station")
+    era5_da = era5_da.isel(longitude=lon_idx, latitude=lat_idx)
 
     # return time series as xarray
     return era5_da
 
-def get_nora3_timeseries(param, lon, lat, start_time, end_time):
+def get_nora3_timeseries(param, lon, lat, start_time, end_time, reference_file=None,
+                         keep_attrs=False, max_workers=1):
     """Time series extraction from NORA3.
 
     Returns time series xarray for parameter param at location (lat, lon) in interval
     [start_time, end_time] with a temporal resolution of one hour. The nearest 
     grid point will be used.
 
+    param may also be a list of parameters, in which case all of them are extracted
+    with the same indexing and returned together as an xarray Dataset.
+
+    If reference_file is given, it must be a kerchunk reference JSON covering the
+    interval (see build_nora3_reference), and the data is read through it instead of
+    opening every hourly file.
+
+    By default the values are read directly from each file with netCDF4, which is much
+    faster than xarray for point extraction, and returned loaded without the variable
+    attributes. Set keep_attrs=True to get the lazy xarray result with attributes.
+    max_workers > 1 reads the files with a pool of that many processes.
+
     Data directories: 
     /lustre/storeB/project/fou/om/WINDSURFER/HM40h12/netcdf [1997-08, 2019-12]
     """
-    data_dir = "/lustre/storeB/project/fou/om/WINDSURFER/HM40h12/netcdf"
-    available_atm_params = ["air_pressure_at_sea_level", "x_wind_10m", "y_wind_10m"]
+    params = [param] if isinstance(param, str) else list(param)
 
     # sanity check arguments
-    if param not in available_atm_params:
-        raise RuntimeError("Undefined parameter: " + param)
-    if 44.0 > lat > 83.0:
+    for a_param in params:
+        if a_param not in NORA3_ATM_PARAMS:
+            raise RuntimeError("Undefined parameter: " + a_param)
+    if np.any(np.asarray(lat) < 44.0) or np.any(np.asarray(lat) > 83.0):
         raise RuntimeError("Latitude (lat) must be in the interval [44.0, 83.0]")
-    if -30.0 > lon > 85.0:
+    if np.any(np.asarray(lon) < -30.0) or np.any(np.asarray(lon) > 85.0):
         raise RuntimeError("Longitude (lon) must be in the interval [-30.0, 85.0]")
     
     #print("From " + start_time.strftime("%Y%m%d-%H"))
     #print("To " + end_time.strftime("%Y%m%d-%H"))
 
-    # find and open correct netCDF file(s)
-    filenames = []
-    hour = timedelta(hours=1)
-    current_time = start_time
-
-    if param in available_atm_params:
-        while current_time <= end_time:
-            current_time_with_offset = current_time - timedelta(hours=4)
-            
-            # find correct period folder
-            if current_time_with_offset.hour < 6:
-                period = 0
-            elif current_time_with_offset.hour < 12:
-                period = 6
-            elif current_time_with_offset.hour < 18:
-                period = 12
-            else:
-                period = 18
-            
-            # find correct index file
-            index_file = current_time.hour - period
-            if index_file < 0:
-                index_file += 24
-
-            filenames.append(
-                os.path.join(data_dir, "{year}/{month}/{day}/{period:02d}/fc{year}{month}{day}{period:02d}_00{index_file}_fp.nc" \
-                .format(year=current_time_with_offset.strftime("%Y"), 
-                        month=current_time_with_offset.strftime("%m"), 
-                        day=current_time_with_offset.strftime("%d"), 
-                        period=period, index_file=index_file)))
-            current_time += hour
+    if reference_file is None and not keep_attrs:
+        # fast path: the grid is read from the first file, the points from every file
+        filenames = _nora3_filenames(start_time, end_time)
+        grid_lat, grid_lon, tree = _nora3_grid(filenames[0])
+
+        y_idx, x_idx = _nearest_grid_indices(grid_lat, grid_lon, lat, lon, tree)
+        point_dims = ("station",) if np.ndim(y_idx) > 0 else ()
+        point_idx = (np.asarray(y_idx), np.asarray(x_idx))
+
+        nora3_ds = _read_nora3_points(filenames, params, y_idx, x_idx, max_workers)
+        nora3_ds = nora3_ds.assign_coords(latitude=(point_dims, grid_lat[point_idx]),
+                                          longitude=(point_dims, grid_lon[point_idx]))
+        nora3_ds = nora3_ds.sel(time=slice(start_time, end_time))
+
+        if isinstance(param, str):
+            return nora3_ds[param]
+        return nora3_ds
+
+    # find and open correct netCDF file(s), keeping only the requested parameters
+    if reference_file is not None:
+        nora3 = xr.open_dataset("reference://", engine="zarr", chunks={},
+                                backend_kwargs={"consolidated": False,
+                                                "storage_options": {"fo": reference_file}})
+        grid_lat, grid_lon, tree = nora3.latitude.values, nora3.longitude.values, None
     else:
-        raise RuntimeError(param + " is not found in NORA3 data set")
-    
-    nora3 = xr.open_mfdataset(filenames)
+        filenames = _nora3_filenames(start_time, end_time)
+        nora3 = _open_nora3(tuple(filenames), tuple(params))
+        grid_lat, grid_lon, tree = _nora3_grid(filenames[0])
 
     # find coordinates in data set projection by transformation:
     #data_crs = ccrs.LambertConformal(central_longitude=-42.0, central_latitude=66.3,
@@ -265,29 +560,88 @@ def get_nora3_timeseries(param, lon, lat, start_time, end_time):
     #print("Projected lon, lat: " + str(nora3_da_lon.values) + ", " + str(nora3_da_lat.values))
     
     # find coordinates in data set projection by lookup in lon-lat variables
-    abslat = np.abs(nora3.latitude-lat)
-    abslon = np.abs(nora3.longitude-lon)
-    cor = np.maximum(abslon, abslat)
-    ([y_idx], [x_idx]) = np.where(cor == np.min(cor))
+    y_idx, x_idx = _nearest_grid_indices(grid_lat, grid_lon, lat, lon, tree)
 
     #print("Projected lon, lat: " 
     #        + str(nora3["longitude"].isel(x=x_idx, y=y_idx).values) + ", " 
     #        + str(nora3["latitude"].isel(x=x_idx, y=y_idx).values))
 
-    # extract data set
+    # extract data set, all parameters in one indexing operation
     #nora3_da = nora3[param].sel(x=x, y=y, method="nearest")
-    nora3_da = nora3[param].isel(x=x_idx, y=y_idx)
-    nora3_da = nora3_da.sel(time=slice(start_time, end_time))
+    nora3_ds = nora3[params].isel(x=x_idx, y=y_idx)
+    nora3_ds = nora3_ds.sel(time=slice(start_time, end_time))
 
     # return time series as xarray
-    return nora3_da
+    if isinstance(param, str):
+        return nora3_ds[param]
+    return nora3_ds
+
+def build_nora3_reference(start_time, end_time, reference_file):
+    """Write a kerchunk reference JSON for the NORA3 files in [start_time, end_time].
+
+    The reference holds the metadata and chunk locations of all the hourly files, so
+    get_nora3_timeseries(..., reference_file=reference_file) reads it once instead of
+    opening and decoding every file. Typically built once per month of data.
+
+    Requires kerchunk, fsspec and zarr.
+    """
+    import json
+    from kerchunk.combine import MultiZarrToZarr
+    from kerchunk.hdf import SingleHdf5ToZarr
+
+    single_refs = []
+    for filename in _nora3_filenames(start_time, end_time):
+        with open(filename, mode="rb") as in_file:
+            single_refs.append(SingleHdf5ToZarr(in_file, filename).translate())
+
+    combined = MultiZarrToZarr(single_refs, concat_dims=["time"],
+                               identical_dims=["x", "y", "latitude", "longitude"]).translate()
+    with open(reference_file, mode="w") as out_file:
+        json.dump(combined, out_file)
+
+def append_stride_to_netcdf(filename, param, times, values):
+    """Append one time stride of param to an output file made by write_timeseries.
+
+    values has shape (station, time). The data is written directly with netCDF4 along
+    the unlimited time dimension, using the encoding already stored in the file, so no
+    xarray Dataset has to be built and encoded for each stride.
+    """
+    with nc4.Dataset(filename, mode="a") as nc:
+        nc_time = nc.variables["time"]
+        time_start = len(nc_time)
+        time_end = time_start + len(times)
+
+        nc_time[time_start:time_end] = nc4.date2num(
+            pd.DatetimeIndex(times).to_pydatetime(), nc_time.units,
+            getattr(nc_time, "calendar", "standard"))
+        nc.variables[param][:, time_start:time_end] = np.ma.masked_invalid(values)
+
+def _output_encoding(param, n_stations):
+    """netCDF encoding of param in the output file of write_timeseries.
+
+    Parameters with a range in OUTPUT_PACKING_RANGES are packed into 16 bit integers,
+    which resolves the range in 65500 steps and halves the file size compared to
+    float32. Others are stored as float32. Chunks hold all stations and about
+    OUTPUT_CHUNK_BYTES of data, rather than the tiny default chunks along the
+    unlimited time dimension.
+    """
+    if param in OUTPUT_PACKING_RANGES:
+        min_value, max_value = OUTPUT_PACKING_RANGES[param]
+        encoding = {"dtype": "int16", "scale_factor": (max_value - min_value) / 65500.0,
+                    "add_offset": (max_value + min_value) / 2.0, "_FillValue": -32767}
+    else:
+        encoding = {"dtype": "float32", "_FillValue": 1.0e37}
+
+    time_chunk = max(1, OUTPUT_CHUNK_BYTES // (np.dtype(encoding["dtype"]).itemsize * n_stations))
+    encoding.update({"zlib": False, "chunksizes": (n_stations, time_chunk)})
+    return encoding
 
 def init_netcdf_output_file(out_da, station_ids, station_lons, station_lats):
     """Initiate netCDF file with observation stations and time as unlimited dimension."""
 
-    out_da["stationid"] = station_ids.astype(str)
-    out_da["longitude_station"] = station_lons
-    out_da["latitude_station"] = station_lats
+    out_da["stationid"] = ("station", station_ids.astype(str))
+    out_da["longitude_station"] = ("station", station_lons)
+    out_da["latitude_station"] = ("station", station_lats)
 
     # ensure CF compliance
     out_da.attrs["Conventions"] = "CF-1.8"
@@ -305,11 +659,34 @@ def init_netcdf_output_file(out_da, station_ids, station_lons, station_lats):
     out_da["latitude_station"].attrs["units"] = "degrees_north"
     out_da["latitude_station"].attrs["long_name"] = "latitude_station"
 
+def read_stations(stations_file):
+    """Read station ids and locations from a netCDF file into numpy arrays.
+
+    The variables are read in one go, so the station loop in write_timeseries works on
+    plain arrays rather than lazy (dask backed) DataArrays.
+    """
+    with xr.open_dataset(stations_file) as stations:
+        return {"stationid": stations["stationid"].values,
+                "latitude": stations["latitude"].values.astype(np.float64),
+                "longitude": stations["longitude"].values.astype(np.float64)}
+
+def _extract_stride(param, station_lons, station_lats, start_time, end_time):
+    """Time series of param at all stations for one time stride of write_timeseries.
+
+    All stations are selected at once and returned (lazily) with station as the first
+    dimension, clipped to the packing range of param.
+    """
+    combined = get_era5_timeseries(param, station_lons, station_lats, start_time, end_time)
+    combined = combined.transpose("station", "time")
+    if param in OUTPUT_PACKING_RANGES:
+        combined = combined.clip(*OUTPUT_PACKING_RANGES[param])
+    return combined
+
 def write_timeseries(stations_file, output_file, param, start_time, end_time):
     """WiP: Get stations (w/locations), do time series extraction from ERA5/NORA3, and write results to netCDF file."""
     # write msl timeseries for the complete ERA5 period for
     # every observation in obs data file (see line below)
-    stations = xr.open_mfdataset(stations_file)
+    stations = read_stations(stations_file)
 
     station_ids = stations["stationid"]
     station_lons = stations["longitude"]
@@ -321,40 +698,34 @@ def write_timeseries(stations_file, output_file, param, start_time, end_time):
     stride_start_time = start_time - timedelta(hours=1)
     stride_end_time = start_time - timedelta(hours=1)
     # stride in time
-    while stride_end_time is not end_time:
+    while stride_end_time < end_time:
         stride_start_time = stride_end_time + timedelta(hours=1)
-        stride_end_time = stride_start_time + timedelta(days=365) - timedelta(hours=1)
-        if stride_end_time > end_time:
-            stride_end_time = end_time
+        stride_end_time = min(stride_start_time + timedelta(days=365) - timedelta(hours=1),
+                              end_time)
 
         print("From " + stride_start_time.strftime("%Y%m%d-%H%M"))
         print("To " + stride_end_time.strftime("%Y%m%d-%H%M"))
 
-        dataarrays = []
+        print("Writing timeseries for " + str(station_ids.size) + " stations")
 
-        for (station_id, station_lon, station_lat) in zip(station_ids, station_lons, station_lats):
-            print("Writing timeseries for station " + str(station_id.values) + " at " 
-                    + str(station_lon.values) + ", " + str(station_lat.values))
-
-            da = get_era5_timeseries(param, station_lon, station_lat, 
-                    stride_start_time, stride_end_time)
-            
-            dataarrays.append(da)
-
-        combined = xr.concat(dataarrays, dim="station")
-        out_da = xr.Dataset()
-        out_da[param] = combined
-        
-        out_da = out_da.chunk(chunks={"station": 1})
-        print(out_da)
+        combined = _extract_stride(param, station_lons, station_lats,
+                                   stride_start_time, stride_end_time)
 
         if not os.path.isfile(output_file):
+            out_da = xr.Dataset()
+            out_da[param] = combined
+            if VERBOSE:
+                print(out_da)
+
             init_netcdf_output_file(out_da, station_ids, station_lons, station_lats)
             out_da.to_netcdf(output_file, 
                                 format="NETCDF4", engine="netcdf4", unlimited_dims="time", mode="w",
-                                encoding={param: {"dtype": "float32", "zlib": False, "_FillValue": 1.0e37}})
+                                encoding={param: _output_encoding(param, station_ids.size)})
         else:
-            append_to_netcdf(output_file, out_da, unlimited_dims="time")
+            combined = combined.load()
+            if VERBOSE:
+                print(combined)
+            append_stride_to_netcdf(output_file, param, combined.time.values, combined.values)
 
 if __name__ == "__main__":
     # TODO: fix memory prob with to_netcdf() in order to write long timeseries w/o appending,
@@ -362,6 +733,7 @@ if __name__ == "__main__":
     #       extract functions (choose time stride, parameter, input and output filenames)
 
     # parse optional arguments
+    #import argparse
     #parser = argparse.ArgumentParser(description="Extract timeseries from NORA3/ERA5 \
     #    data sets based on location and time interval fetched from netCDF-files containing \
     #    stations, and write to netCDF.")